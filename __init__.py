@@ -1,150 +1,292 @@
-import xml.etree.ElementTree as ET
-from collections import defaultdict
+import re
+import time
+from functools import lru_cache
 from textwrap import dedent
-from urllib.request import urlopen
-from copy import copy
+from xml.parsers import expat
 
-from cachetools import TTLCache
+import httpx
 from opsdroid.connector.matrix import ConnectorMatrix
 from opsdroid.connector.matrix.events import GenericMatrixRoomEvent
-from opsdroid.events import Message
-from opsdroid.matchers import match_regex
+from opsdroid.events import Message, OpsdroidStarted
+from opsdroid.matchers import match_crontab, match_event, match_regex
 from opsdroid.skill import Skill
-from tabulate import tabulate
 
 HAMBOT_COMMAND_PREFIX = "!"
 HAMBOT_COMMANDS = {}
+HAMBOT_HANDLERS = {}
+# Incremented every time a command is registered, used to invalidate the help text
+HAMBOT_COMMANDS_VERSION = 0
+_HELP_CACHE = {"version": -1, "text": ""}
 
+BAND_HEADERS = ("Band", "Day", "Night")
+HEADER_TEMPLATE = "Bands as of {updated}: SFI={solarflux} SN={sunspots} A={aindex} K={kindex}"
+# The solar info fields used in the responses
+INFO_KEYS = ("updated", "solarflux", "sunspots", "aindex", "kindex")
+# Pre-coloured HTML cells for each of the band condition values
+COLOUR_MAP = {
+    "Good": "<font data-mx-color='#00cc00' color='#00cc00'>Good</font>",
+    "Poor": "<font data-mx-color='#cc0000' color='#cc0000'>Poor</font>",
+    "Fair": "<font data-mx-color='#ffcc00' color='#ffcc00'>Fair</font>",
+}
 
-def regex_command(command, description="", **kwargs):
+
+def format_table(rows, headers):
+    """
+    Render a plain text table in the same layout as tabulate's default "simple" format.
+    """
+    rows = [["" if cell is None else cell for cell in row] for row in rows]
+    widths = [max([len(header) + 2, *(len(row[i]) for row in rows)]) for i, header in enumerate(headers)]
+    lines = [headers, ["-" * width for width in widths], *rows]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip() for line in lines)
+
+
+def format_html_table(rows, headers):
+    """
+    Render a HTML table, cells are inserted without escaping.
+    """
+    head = "".join(f"<th>{header}</th>" for header in headers)
+    body = "".join("<tr>" + "".join(f"<td>{'' if cell is None else cell}</td>" for cell in row) + "</tr>" for row in rows)
+    return f"<table><thead><tr>{head}</tr></thead><tbody>{body}</tbody></table>"
+
+
+def regex_command(command, description=""):
     """
-    A decorator which wraps opsdroid's match_regex to register a command with the !help command.
+    A decorator which registers a command with the !help command and the command dispatcher.
     """
+    global HAMBOT_COMMANDS_VERSION
     HAMBOT_COMMANDS[command] = description
+    HAMBOT_COMMANDS_VERSION += 1
     def decorator(func):
-        return match_regex(f"^{HAMBOT_COMMAND_PREFIX}{command}", **kwargs)(func)
+        HAMBOT_HANDLERS[command] = func
+        return func
     return decorator
 
 
-@regex_command("help", "print this help message")
-async def help(opsdroid, config, message):
+def command_regex():
+    """
+    A single regex matching every registered command, the command name is captured in group 1.
+    """
+    commands = "|".join(re.escape(command) for command in HAMBOT_COMMANDS)
+    return f"^{re.escape(HAMBOT_COMMAND_PREFIX)}({commands})\\b"
+
+
+def _build_help_text():
+    """
+    Render the help text, re-rendering it only if a command has been registered since it was last built.
+    """
+    if _HELP_CACHE["version"] == HAMBOT_COMMANDS_VERSION:
+        return _HELP_CACHE["text"]
+
     commands = "\n".join([f"{HAMBOT_COMMAND_PREFIX}{command} - {description}" for command, description in HAMBOT_COMMANDS.items()])
-    help_text = dedent("""\
+    _HELP_CACHE["text"] = dedent("""\
     Hambot understands the following commands:
 
     {commands}
     """).format(commands=commands)
-    await message.respond(help_text)
+    _HELP_CACHE["version"] = HAMBOT_COMMANDS_VERSION
+    return _HELP_CACHE["text"]
+
+
+# The parts of a matrix message content which do not change between responses
+_MATRIX_BASE = {
+    "body": "",
+    "format": "org.matrix.custom.html",
+    "formatted_body": "",
+    "msgtype": "m.notice",
+}
+
+
+@lru_cache(maxsize=32)
+def _is_matrix(connector_type):
+    """
+    Check if a connector class is a matrix connector, the result is cached per class.
+    """
+    return issubclass(connector_type, ConnectorMatrix)
 
 
 def rich_response(message, body, formatted_body):
-    if isinstance(message.connector, ConnectorMatrix):
-        return GenericMatrixRoomEvent(
-            "m.room.message",
-            {
-                "body": body,
-                "format": "org.matrix.custom.html",
-                "formatted_body": formatted_body,
-                "msgtype": "m.notice" if message.connector.send_m_notice else "m.text",
-            },
-        )
+    if _is_matrix(type(message.connector)):
+        content = _MATRIX_BASE.copy()
+        content["body"] = body
+        content["formatted_body"] = formatted_body
+        if not message.connector.send_m_notice:
+            content["msgtype"] = "m.text"
+        return GenericMatrixRoomEvent("m.room.message", content)
     else:
         return Message(body)
 
 
-class SolarInfo(Skill):
+class _Slot:
     """
-    An opsdroid skill to retrieve propagation information.
+    A cache holding a single value which expires a fixed time after it was set.
     """
-    cache = TTLCache(maxsize=10, ttl=60*60)  # Only retrieve the data every hour
+    __slots__ = ("value", "expiry", "ttl")
+
+    def __init__(self, ttl):
+        self.value = None
+        self.expiry = 0.0
+        self.ttl = ttl
+
+    def get(self, now):
+        return self.value if now < self.expiry else None
+
+    def set(self, value, now):
+        self.value = value
+        self.expiry = now + self.ttl
+
+
+class SolarXMLParser:
+    """
+    An expat parser which builds the band, VHF and solar information as the hamqsl XML feed is fed in.
+    """
+    # Elements which only contain other elements
+    CONTAINERS = ("solar", "solardata", "calculatedconditions", "calculatedvhfconditions")
+
+    def __init__(self):
+        self.bands = {}  # Band name to a [band, day, night] table row
+        self.vhf = {}
+        self.info = {}
+        self._attrs = None
+        self._text = []
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.CharacterDataHandler = self._text_data
+        self._parser.EndElementHandler = self._end
+
+    def feed(self, data):
+        self._parser.Parse(data, False)
+
+    def close(self):
+        self._parser.Parse(b"", True)
+
+    def _start(self, name, attrs):
+        self._attrs = attrs
+        self._text = []
 
-    def get_solarxml(self):
-        if "solarxml" not in self.cache:
-            resp = urlopen("https://www.hamqsl.com/solarxml.php")
-            root = ET.fromstring(resp.read())
-            self.cache["solarxml"] = root
-        return self.cache["solarxml"]
+    def _text_data(self, data):
+        self._text.append(data)
+
+    def _end(self, name):
+        if name in self.CONTAINERS or not self._text:
+            return
+        text = "".join(self._text)
+        attrs = self._attrs
+        if name == "band":
+            band = attrs["name"]
+            row = self.bands.setdefault(band, [band, None, None])
+            row[1 if attrs["time"] == "day" else 2] = text
+        elif name == "phenomenon":
+            phenomenon = attrs["name"].replace("-", " ").title().replace("Vhf", "VHF")
+            location = attrs["location"].replace("_", " ").title()
+            self.vhf.setdefault(phenomenon, {})[location] = text
+        else:
+            self.info[name] = text
 
-    @property
     def band_info(self):
-        solar = self.get_solarxml()[0]
-
-        conditions = solar.find("calculatedconditions")
-        bands = defaultdict(dict)
-        for band in conditions.iter("band"):
-            bands[band.attrib["name"]][band.attrib["time"]] = band.text
-
-        band_table = {"tabular_data": [], "headers": ["Band", "Day", "Night"]}
-        for band, conditions in bands.items():
-            band_table["tabular_data"].append([band, conditions["day"], conditions["night"]])
-
-        vhfconditions = solar.find("calculatedvhfconditions")
-        vhf = defaultdict(dict)
-        for band in vhfconditions.iter("phenomenon"):
-            name = band.attrib["name"].replace("-", " ").title().replace("Vhf", "VHF")
-            location = band.attrib["location"].replace("_", " ").title()
-            vhf[name][location] = band.text
-
-        info = {}
-        for tag in solar:
-            if tag.tag.startswith("calculated"):
-                continue
-            if tag.text is not None:
-                info[tag.tag] = tag.text.strip()
-
-        band_info = {
-            "bands": band_table,
-            "vhf": dict(vhf),
-            "info": info,
+        rows_plain = list(self.bands.values())
+        rows_html = [tuple(COLOUR_MAP.get(cell, cell) for cell in row) for row in rows_plain]
+
+        return {
+            "bands_rows_plain": rows_plain,
+            "bands_rows_html": rows_html,
+            "vhf": self.vhf,
+            "info": self.info,
         }
+
+
+class SolarInfo(Skill):
+    """
+    An opsdroid skill to retrieve propagation information.
+
+    All the hambot commands are dispatched through a single regex matcher, see `dispatch`.
+    """
+    # refresh_band_info updates the data every hour, the longer TTL only
+    # expires it if the scheduled refreshes start failing.
+    cache = _Slot(ttl=2*60*60)
+    # Shared so the connection to hamqsl.com is reused between refreshes
+    _client = httpx.AsyncClient(
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+    )
+
+    @regex_command("help", "print this help message")
+    async def help(self, message):
+        await message.respond(_build_help_text())
+
+    def render_band_info(self, band_info):
+        """
+        Render the plain text and HTML responses for the bands and vhf commands.
+        """
+        # Only strip the info fields which are actually used
+        info = band_info["info"] = {key: band_info["info"][key].strip() for key in INFO_KEYS}
+
+        # Template a header row
+        template = band_info["header"] = HEADER_TEMPLATE.format(**info)
+
+        html_table = format_html_table(band_info["bands_rows_html"], BAND_HEADERS)
+
+        band_info["bands_plain"] = template + "\n" + format_table(band_info["bands_rows_plain"], BAND_HEADERS)
+        band_info["bands_html"] = f"<h4>{template.split(':')[0]}</h4>{template.split(':')[1]}<br />{html_table}"
+
+        # Build the plain text and HTML reports in a single pass over the VHF conditions
+        resp = [f"VHF Conditions as of {info['updated']}"]
+        html_resp = [f"<h4>VHF Conditions as of {info['updated']}</h4>"]
+        for prop, regions in band_info["vhf"].items():
+            resp.append(f"{prop}:")
+            html_resp.append(f"<h5>{prop}</h5>")
+            for region, status in regions.items():
+                resp.append(f"\t{region}: {status}")
+                html_resp.append(f"<b>{region}</b>: {status}<br />")
+
+        band_info["vhf_plain"] = "\n".join(resp)
+        band_info["vhf_html"] = "".join(html_resp)
         return band_info
 
+    async def get_solarxml(self):
+        # Feed the response into the parser as it arrives rather than buffering the whole body
+        parser = SolarXMLParser()
+        async with self._client.stream("GET", "https://www.hamqsl.com/solarxml.php") as resp:
+            resp.raise_for_status()
+            async for chunk in resp.aiter_bytes():
+                parser.feed(chunk)
+        parser.close()
+        return self.render_band_info(parser.band_info())
+
+    async def _get_band_info(self):
+        band_info = self.cache.get(time.monotonic())
+        if band_info is None:
+            band_info = await self.get_solarxml()
+            self.cache.set(band_info, time.monotonic())
+        return band_info
+
+    @match_event(OpsdroidStarted)
+    @match_crontab("0 * * * *")
+    async def refresh_band_info(self, event):
+        """
+        Update the cached band info in the background so commands never wait on the network.
+        """
+        band_info = await self.get_solarxml()
+        self.cache.set(band_info, time.monotonic())
+
     @regex_command("bands", "print a propagation prediction for the HF bands.")
     async def bands(self, message):
-        band_info = self.band_info
-        # Template a header row
-        template = "Bands as of {updated}: SFI={solarflux} SN={sunspots} A={aindex} K={kindex}"
-        template = template.format(**band_info["info"])
-
-        # Colourise the html table
-        html_rows = copy(band_info["bands"])
-        colour = {
-            "Good": " data-mx-color='#00cc00' color='#00cc00'",
-            "Poor": " data-mx-color='#cc0000' color='#cc0000'",
-            "Fair": " data-mx-color='#ffcc00' color='#ffcc00'",
-        }
-        new_rows = []
-        for row in html_rows["tabular_data"]:
-            new_rows.append([f"<font{colour[r]}>{r}</font>" if r in colour else r for r in row])
-        html_rows["tabular_data"] = new_rows
-        html_table = tabulate(**html_rows, tablefmt="unsafehtml")
-
+        band_info = await self._get_band_info()
         # Generate the event class based on the connector type
-        event = rich_response(
-            message,
-            template + "\n" + tabulate(**band_info["bands"]),
-            f"<h4>{template.split(':')[0]}</h4>{template.split(':')[1]}<br />{html_table}",
-        )
+        event = rich_response(message, band_info["bands_plain"], band_info["bands_html"])
         await message.respond(event)
 
     @regex_command("vhf", "print a report on VHF propagation effects.")
     async def vhf(self, message):
-        vhf_info = self.band_info["vhf"]
-        resp = [f"VHF Conditions as of {self.band_info['info']['updated']}"]
-        for prop, info in vhf_info.items():
-            resp.append(f"{prop}:")
-            for region, status in info.items():
-                resp.append(f"\t{region}: {status}")
-
-        html_resp = [f"<h4>VHF Conditions as of {self.band_info['info']['updated']}</h4>"]
-        for prop, info in vhf_info.items():
-            html_resp.append(f"<h5>{prop}</h5>")
-            for region, status in info.items():
-                html_resp.append(f"<b>{region}</b>: {status}<br />")
-
-        event = rich_response(
-            message,
-            "\n".join(resp),
-            "".join(html_resp),
-        )
+        band_info = await self._get_band_info()
+        event = rich_response(message, band_info["vhf_plain"], band_info["vhf_html"])
         await message.respond(event)
+
+    # This must stay at the end of the class so every command has been registered
+    @match_regex(command_regex())
+    async def dispatch(self, message):
+        """
+        Call the handler for the command matched by the combined command regex.
+        """
+        await HAMBOT_HANDLERS[message.regex.group(1)](self, message)